@@ -20,20 +20,46 @@ from torch.utils.data import Dataset, DataLoader
 import torch.utils.data.distributed
 from torchvision import transforms
 from PIL import Image
+import cv2
 import os
-import random
+import hashlib
 
 from distributed_sampler_no_evenly_divisible import *
 
 
-def _is_pil_image(img):
-    return isinstance(img, Image.Image)
-
-
 def _is_numpy_image(img):
     return isinstance(img, np.ndarray) and (img.ndim in {2, 3})
 
 
+def worker_init_fn(worker_id):
+    # Give every worker its own random generator, seeded like torch is in that worker
+    worker_info = torch.utils.data.get_worker_info()
+    worker_info.dataset.rng = np.random.default_rng(worker_info.seed)
+
+    # Rotation and the augmentation lookup run with OpenCV, keep them on the worker's own thread
+    # so the workers do not oversubscribe the CPU, this also avoids thread pool hangs after fork
+    cv2.setNumThreads(0)
+
+
+DECODED_CACHE_DIR = '/dev/shm/bts'
+
+
+def _read_image(path):
+    image = np.asarray(Image.open(path))
+    if image is None:
+        raise IOError('cannot read {}'.format(path))
+    return image
+
+
+def _read_depth(path):
+    # libpng decodes the 16-bit depth maps straight into a uint16 array,
+    # cv2.imread returns None instead of raising for missing or unreadable files
+    depth = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if depth is None:
+        raise IOError('cannot read {}'.format(path))
+    return depth
+
+
 def preprocessing_transforms(mode):
     return transforms.Compose([
         ToTensor(mode=mode)
@@ -48,12 +74,16 @@ class BtsDataLoader(object):
                 self.train_sampler = torch.utils.data.distributed.DistributedSampler(self.training_samples)
             else:
                 self.train_sampler = None
-    
+
+            # Keep the workers and their prefetched batches alive across epochs
+            worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 4} if args.num_threads > 0 else {}
             self.data = DataLoader(self.training_samples, args.batch_size,
                                    shuffle=(self.train_sampler is None),
                                    num_workers=args.num_threads,
                                    pin_memory=True,
-                                   sampler=self.train_sampler)
+                                   sampler=self.train_sampler,
+                                   worker_init_fn=worker_init_fn,
+                                   **worker_kwargs)
 
         elif mode == 'online_eval':
             self.testing_samples = DataLoadPreprocess(args, mode, transform=preprocessing_transforms(mode))
@@ -66,11 +96,13 @@ class BtsDataLoader(object):
                                    shuffle=False,
                                    num_workers=1,
                                    pin_memory=True,
-                                   sampler=self.eval_sampler)
+                                   sampler=self.eval_sampler,
+                                   persistent_workers=True,
+                                   prefetch_factor=4)
         
         elif mode == 'test':
             self.testing_samples = DataLoadPreprocess(args, mode, transform=preprocessing_transforms(mode))
-            self.data = DataLoader(self.testing_samples, 1, shuffle=False, num_workers=1)
+            self.data = DataLoader(self.testing_samples, 1, shuffle=False, num_workers=1, pin_memory=True, prefetch_factor=4)
 
         else:
             print('mode should be one of \'train, test, online_eval\'. Got {}'.format(mode))
@@ -80,51 +112,77 @@ class DataLoadPreprocess(Dataset):
     def __init__(self, args, mode, transform=None, is_for_online_eval=False):
         self.args = args
         if mode == 'online_eval':
-            with open(args.filenames_file_eval, 'r') as f:
-                self.filenames = f.readlines()
+            filenames_file = args.filenames_file_eval
+            data_path = args.data_path_eval
+            gt_path = args.gt_path_eval
         else:
-            with open(args.filenames_file, 'r') as f:
-                self.filenames = f.readlines()
-    
+            filenames_file = args.filenames_file
+            data_path = args.data_path
+            gt_path = args.gt_path if mode == 'train' else None
+
+        # Each line holds the image path, the depth path and the focal length,
+        # KITTI training lines may be followed by the right image and depth paths
+        with open(filenames_file, 'r') as f:
+            samples = [line.split() for line in f if line.strip()]
+        self.focals = np.fromiter((float(sample[2]) for sample in samples), dtype=np.float32, count=len(samples))
+
+        # Paths in the NYU lists start with '/', so strip it to keep them relative to the data directories
+        self.image_paths = [os.path.join(data_path, sample[0].lstrip('/')) for sample in samples]
+        self.depth_paths = None
+        if gt_path is not None:
+            self.depth_paths = [os.path.join(gt_path, sample[1].lstrip('/')) for sample in samples]
+        self.right_paths = None
+        if mode == 'train' and args.dataset == 'kitti' and args.use_right is True:
+            self.right_paths = [(os.path.join(data_path, sample[3].lstrip('/')),
+                                 os.path.join(gt_path, sample[4].lstrip('/'))) for sample in samples]
+
+        if args.cache_decoded is True:
+            os.makedirs(DECODED_CACHE_DIR, exist_ok=True)
+
         self.mode = mode
+        # Replaced per worker by worker_init_fn
+        self.rng = np.random.default_rng()
         self.transform = transform
         self.to_tensor = ToTensor
         self.is_for_online_eval = is_for_online_eval
     
     def __getitem__(self, idx):
-        sample_path = self.filenames[idx]
-        focal = float(sample_path.split()[2])
+        focal = self.focals[idx]
 
         if self.mode == 'train':
-            if self.args.dataset == 'kitti' and self.args.use_right is True and random.random() > 0.5:
-                image_path = os.path.join(self.args.data_path, "./" + sample_path.split()[3])
-                depth_path = os.path.join(self.args.gt_path, "./" + sample_path.split()[4])
+            # All random parameters of a training sample come from a single draw:
+            # right image, rotation, crop x and y, flip, augmentation, gamma, brightness and 3 colors
+            rand = self.rng.random(11)
+            if self.right_paths is not None and rand[0] > 0.5:
+                image_path, depth_path = self.right_paths[idx]
             else:
-                image_path = os.path.join(self.args.data_path, "./" + sample_path.split()[0])
-                depth_path = os.path.join(self.args.gt_path, "./" + sample_path.split()[1])
+                image_path = self.image_paths[idx]
+                depth_path = self.depth_paths[idx]
     
-            image = Image.open(image_path)
-            depth_gt = Image.open(depth_path)
-            
+            image = self.decode(image_path, _read_image)
+            depth_gt = self.decode(depth_path, _read_depth)
+
+            # The deterministic crops are combined into a single slice of the decoded arrays
+            top_margin, left_margin = 0, 0
+            height, width = image.shape[:2]
             if self.args.do_kb_crop is True:
-                height = image.height
-                width = image.width
                 top_margin = int(height - 352)
                 left_margin = int((width - 1216) / 2)
-                depth_gt = depth_gt.crop((left_margin, top_margin, left_margin + 1216, top_margin + 352))
-                image = image.crop((left_margin, top_margin, left_margin + 1216, top_margin + 352))
-            
+                height, width = 352, 1216
+
             # To avoid blank boundaries due to pixel registration
             if self.args.dataset == 'nyu':
-                depth_gt = depth_gt.crop((43, 45, 608, 472))
-                image = image.crop((43, 45, 608, 472))
-    
+                top_margin += 45
+                left_margin += 43
+                height, width = 427, 565
+
+            image = image[top_margin:top_margin + height, left_margin:left_margin + width]
+            depth_gt = depth_gt[top_margin:top_margin + height, left_margin:left_margin + width]
+
             if self.args.do_random_rotate is True:
-                random_angle = (random.random() - 0.5) * 2 * self.args.degree
-                image = self.rotate_image(image, random_angle)
-                depth_gt = self.rotate_image(depth_gt, random_angle, flag=Image.NEAREST)
-            
-            image = np.asarray(image, dtype=np.float32) / 255.0
+                random_angle = (rand[1] - 0.5) * 2 * self.args.degree
+                image, depth_gt = self.rotate_image(image, depth_gt, random_angle)
+
             depth_gt = np.asarray(depth_gt, dtype=np.float32)
             depth_gt = np.expand_dims(depth_gt, axis=2)
 
@@ -133,29 +191,25 @@ class DataLoadPreprocess(Dataset):
             else:
                 depth_gt = depth_gt / 256.0
 
-            image, depth_gt = self.random_crop(image, depth_gt, self.args.input_height, self.args.input_width)
-            image, depth_gt = self.train_preprocess(image, depth_gt)
-            sample = {'image': image, 'depth': depth_gt, 'focal': focal}
+            image, depth_gt = self.random_crop(image, depth_gt, self.args.input_height, self.args.input_width, rand[2:4])
+            image, depth_gt, do_flip = self.train_preprocess(image, depth_gt, rand[4:])
+            sample = {'image': image, 'depth': depth_gt, 'focal': focal, 'flip': do_flip}
         
         else:
-            if self.mode == 'online_eval':
-                data_path = self.args.data_path_eval
-            else:
-                data_path = self.args.data_path
+            if self.mode == 'test' and self.args.gpu_decode is True:
+                # Hand over the encoded JPEG, bts_test.py decodes and crops it on the GPU
+                from torchvision.io import read_file
+                return {'image': read_file(self.image_paths[idx]), 'focal': torch.tensor(focal, dtype=torch.float32)}
 
-            image_path = os.path.join(data_path, "./" + sample_path.split()[0])
-            image = np.asarray(Image.open(image_path), dtype=np.float32) / 255.0
+            image = self.decode(self.image_paths[idx], _read_image)
 
             if self.mode == 'online_eval':
-                gt_path = self.args.gt_path_eval
-                depth_path = os.path.join(gt_path, "./" + sample_path.split()[1])
-                has_valid_depth = False
-                try:
-                    depth_gt = Image.open(depth_path)
-                    has_valid_depth = True
-                except IOError:
+                depth_path = self.depth_paths[idx]
+                depth_gt = self.decode(depth_path, _read_depth) if os.path.isfile(depth_path) else None
+                has_valid_depth = depth_gt is not None
+                if not has_valid_depth:
                     depth_gt = False
-                    # print('Missing gt for {}'.format(image_path))
+                    # print('Missing gt for {}'.format(self.image_paths[idx]))
 
                 if has_valid_depth:
                     depth_gt = np.asarray(depth_gt, dtype=np.float32)
@@ -184,108 +238,131 @@ class DataLoadPreprocess(Dataset):
         
         return sample
     
-    def rotate_image(self, image, angle, flag=Image.BILINEAR):
-        result = image.rotate(angle, resample=flag)
-        return result
+    def decode(self, path, read_fn):
+        if self.args.cache_decoded is not True:
+            return read_fn(path)
+
+        # Decoded arrays are saved to shared memory once and memory-mapped afterwards,
+        # a source file that is modified or replaced gets a new cache entry
+        stat = os.stat(path)
+        cache_key = '{}:{}:{}'.format(path, stat.st_mtime_ns, stat.st_size)
+        cache_name = hashlib.md5(cache_key.encode('utf-8')).hexdigest() + '.npy'
+        cache_path = os.path.join(DECODED_CACHE_DIR, cache_name)
+        if os.path.isfile(cache_path):
+            return np.load(cache_path, mmap_mode='r')
+
+        array = read_fn(path)
+
+        # Other workers must never load a partially written file
+        temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # /dev/shm is full, leave the remaining space to the DataLoader and serve this array uncached
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return array
+
+    def rotate_image(self, image, depth, angle):
+        # Rotates counter-clockwise about the center like PIL's Image.rotate, filling the corners with zeros
+        height, width = image.shape[:2]
+        rotation = cv2.getRotationMatrix2D(((width - 1) / 2.0, (height - 1) / 2.0), angle, 1.0)
+        image = cv2.warpAffine(image, rotation, (width, height), flags=cv2.INTER_LINEAR)
+        depth = cv2.warpAffine(depth, rotation, (width, height), flags=cv2.INTER_NEAREST)
+        return image, depth
 
-    def random_crop(self, img, depth, height, width):
+    def random_crop(self, img, depth, height, width, rand):
         assert img.shape[0] >= height
         assert img.shape[1] >= width
         assert img.shape[0] == depth.shape[0]
         assert img.shape[1] == depth.shape[1]
-        x = random.randint(0, img.shape[1] - width)
-        y = random.randint(0, img.shape[0] - height)
+        x = int(rand[0] * (img.shape[1] - width + 1))
+        y = int(rand[1] * (img.shape[0] - height + 1))
         img = img[y:y + height, x:x + width, :]
         depth = depth[y:y + height, x:x + width, :]
         return img, depth
 
-    def train_preprocess(self, image, depth_gt):
-        # Random flipping
-        do_flip = random.random()
-        if do_flip > 0.5:
-            image = (image[:, ::-1, :]).copy()
-            depth_gt = (depth_gt[:, ::-1, :]).copy()
+    def train_preprocess(self, image, depth_gt, rand):
+        # Random flipping, ToTensor flips while copying to CHW
+        do_flip = rand[0] > 0.5
     
         # Random gamma, brightness, color augmentation
-        do_augment = random.random()
+        do_augment = rand[1]
         if do_augment > 0.5:
-            image = self.augment_image(image)
+            image = self.augment_image(image, rand[2:])
     
-        return image, depth_gt
+        return image, depth_gt, do_flip
     
-    def augment_image(self, image):
+    def augment_image(self, image, rand):
         # gamma augmentation
-        gamma = random.uniform(0.9, 1.1)
-        image_aug = image ** gamma
+        gamma = 0.9 + 0.2 * rand[0]
 
         # brightness augmentation
         if self.args.dataset == 'nyu':
-            brightness = random.uniform(0.75, 1.25)
+            brightness = 0.75 + 0.5 * rand[1]
         else:
-            brightness = random.uniform(0.9, 1.1)
-        image_aug = image_aug * brightness
+            brightness = 0.9 + 0.2 * rand[1]
 
-        # color augmentation
-        colors = np.random.uniform(0.9, 1.1, size=3)
-        white = np.ones((image.shape[0], image.shape[1]))
-        color_image = np.stack([white * colors[i] for i in range(3)], axis=2)
-        image_aug *= color_image
-        image_aug = np.clip(image_aug, 0, 1)
+        # color augmentation, applied together with brightness as one per-channel scale
+        colors = 0.9 + 0.2 * rand[2:5]
 
-        return image_aug
+        # The augmentation only depends on the pixel value and its channel, so evaluate it once
+        # for each of the 256 uint8 values and look the results up.
+        # Images stay uint8 until they reach the GPU, see NormalizeImage
+        values = np.arange(256, dtype=np.float32) / 255.0
+        table = (values ** gamma)[np.newaxis, :] * (brightness * colors).astype(np.float32)[:, np.newaxis]
+        table = np.rint(np.clip(table, 0, 1) * 255.0).astype(np.uint8)
+        return cv2.LUT(image, table.T.reshape(256, 1, 3))
     
     def __len__(self):
-        return len(self.filenames)
+        return len(self.image_paths)
 
 
 class ToTensor(object):
     def __init__(self, mode):
         self.mode = mode
-        self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
     
     def __call__(self, sample):
         image, focal = sample['image'], sample['focal']
-        image = self.to_tensor(image)
-        image = self.normalize(image)
+        # As a tensor, collate stacks the focal lengths and pin_memory pins them with the images
+        focal = torch.tensor(focal, dtype=torch.float32)
+        flip = sample.get('flip', False)
+        image = self.to_tensor(image, flip)
 
         if self.mode == 'test':
             return {'image': image, 'focal': focal}
 
         depth = sample['depth']
         if self.mode == 'train':
-            depth = self.to_tensor(depth)
+            depth = self.to_tensor(depth, flip)
             return {'image': image, 'depth': depth, 'focal': focal}
         else:
             has_valid_depth = sample['has_valid_depth']
             return {'image': image, 'depth': depth, 'focal': focal, 'has_valid_depth': has_valid_depth}
     
-    def to_tensor(self, pic):
-        if not (_is_pil_image(pic) or _is_numpy_image(pic)):
+    def to_tensor(self, pic, flip=False):
+        # Samples are always HWC numpy arrays by the time they reach ToTensor
+        if not _is_numpy_image(pic):
             raise TypeError(
-                'pic should be PIL Image or ndarray. Got {}'.format(type(pic)))
-        
-        if isinstance(pic, np.ndarray):
-            img = torch.from_numpy(pic.transpose((2, 0, 1)))
-            return img
-        
-        # handle PIL Image
-        if pic.mode == 'I':
-            img = torch.from_numpy(np.array(pic, np.int32, copy=False))
-        elif pic.mode == 'I;16':
-            img = torch.from_numpy(np.array(pic, np.int16, copy=False))
-        else:
-            img = torch.ByteTensor(torch.ByteStorage.from_buffer(pic.tobytes()))
-        # PIL image mode: 1, L, P, I, F, RGB, YCbCr, RGBA, CMYK
-        if pic.mode == 'YCbCr':
-            nchannel = 3
-        elif pic.mode == 'I;16':
-            nchannel = 1
-        else:
-            nchannel = len(pic.mode)
-        img = img.view(pic.size[1], pic.size[0], nchannel)
-        
-        img = img.transpose(0, 1).transpose(0, 2).contiguous()
-        if isinstance(img, torch.ByteTensor):
-            return img.float()
-        else:
-            return img
+                'pic should be ndarray. Got {}'.format(type(pic)))
+
+        # Horizontal flip and HWC to CHW transpose are both views, resolved by a single copy
+        if flip:
+            pic = pic[:, ::-1, :]
+        return torch.from_numpy(np.ascontiguousarray(pic.transpose((2, 0, 1))))
+
+
+class NormalizeImage(object):
+    def __init__(self):
+        # ImageNet statistics on the uint8 scale, so that scaling to [0, 1] is folded into normalization
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1) * 255.0
+        self.std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1) * 255.0
+
+    def __call__(self, image):
+        # The data loader hands over uint8 images, normalize them on the device they were moved to
+        if self.mean.device != image.device:
+            self.mean = self.mean.to(image.device)
+            self.std = self.std.to(image.device)
+        return image.float().sub_(self.mean).div_(self.std)
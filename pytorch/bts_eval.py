@@ -151,6 +151,7 @@ def test(params):
     
     args.mode = 'test'
     dataloader = BtsDataLoader(args, 'eval')
+    normalize_image = NormalizeImage()
     
     model = BtsModel(params=params)
     model = torch.nn.DataParallel(model)
@@ -183,8 +184,8 @@ def test(params):
         start_time = time.time()
         with torch.no_grad():
             for _, sample in enumerate(dataloader.data):
-                image = Variable(sample['image'].cuda())
-                focal = Variable(sample['focal'].cuda())
+                image = Variable(normalize_image(sample['image'].cuda(non_blocking=True)))
+                focal = Variable(sample['focal'].cuda(non_blocking=True))
                 # image = Variable(sample['image'])
                 # focal = Variable(sample['focal'])
                 # Predict
@@ -88,6 +88,9 @@ parser.add_argument('--do_random_rotate',                      help='if set, wil
 parser.add_argument('--degree',                    type=float, help='random rotation maximum degree', default=2.5)
 parser.add_argument('--do_kb_crop',                            help='if set, crop input images as kitti benchmark images', action='store_true')
 parser.add_argument('--use_right',                             help='if set, will randomly use right images when train on KITTI', action='store_true')
+parser.add_argument('--cache_decoded',                         help='if set, caches decoded images and depth maps in /dev/shm/bts, '
+                                                                    'needs enough RAM to hold the whole decoded dataset, '
+                                                                    'shares /dev/shm with the DataLoader workers sending batches', action='store_true')
 
 # Multi-gpu training
 parser.add_argument('--num_threads',               type=int,   help='number of threads to use for data loading', default=1)
@@ -133,6 +136,7 @@ elif args.mode == 'train' and args.checkpoint_path:
         vars()[key] = val
 
 
+normalize_image = NormalizeImage()
 inv_normalize = transforms.Normalize(
     mean=[-0.485/0.229, -0.456/0.224, -0.406/0.225],
     std=[1/0.229, 1/0.224, 1/0.225]
@@ -251,7 +255,7 @@ def online_eval(model, dataloader_eval, gpu, ngpus):
     eval_measures = torch.zeros(10).cuda(device=gpu)
     for _, eval_sample_batched in enumerate(tqdm(dataloader_eval.data)):
         with torch.no_grad():
-            image = torch.autograd.Variable(eval_sample_batched['image'].cuda(gpu, non_blocking=True))
+            image = torch.autograd.Variable(normalize_image(eval_sample_batched['image'].cuda(gpu, non_blocking=True)))
             focal = torch.autograd.Variable(eval_sample_batched['focal'].cuda(gpu, non_blocking=True))
             gt_depth = eval_sample_batched['depth']
             has_valid_depth = eval_sample_batched['has_valid_depth']
@@ -440,7 +444,7 @@ def main_worker(gpu, ngpus_per_node, args):
             optimizer.zero_grad()
             before_op_time = time.time()
 
-            image = torch.autograd.Variable(sample_batched['image'].cuda(args.gpu, non_blocking=True))
+            image = torch.autograd.Variable(normalize_image(sample_batched['image'].cuda(args.gpu, non_blocking=True)))
             focal = torch.autograd.Variable(sample_batched['focal'].cuda(args.gpu, non_blocking=True))
             depth_gt = torch.autograd.Variable(sample_batched['depth'].cuda(args.gpu, non_blocking=True))
 
@@ -58,6 +58,8 @@ parser.add_argument('--dataset', type=str, help='dataset to train on, make3d or
 parser.add_argument('--do_kb_crop', help='if set, crop input images as kitti benchmark images', action='store_true')
 parser.add_argument('--save_lpg', help='if set, save outputs from lpg layers', action='store_true')
 parser.add_argument('--bts_size', type=int,   help='initial num_filters in bts', default=512)
+parser.add_argument('--gpu_decode', help='if set, decode input images on the GPU with nvJPEG, JPEG inputs only', action='store_true')
+parser.add_argument('--cache_decoded', help='if set, caches decoded images in /dev/shm/bts, which is shared with the DataLoader workers', action='store_true')
 
 if sys.argv.__len__() == 2:
     arg_filename_with_prefix = '@' + sys.argv[1]
@@ -85,6 +87,10 @@ def test(params):
     """Test function."""
     args.mode = 'test'
     dataloader = BtsDataLoader(args, 'test')
+    normalize_image = NormalizeImage()
+    if args.gpu_decode:
+        # Only needed for decoding on the GPU, which requires torchvision 0.10 or later
+        from torchvision.io import decode_jpeg, ImageReadMode
     
     model = BtsModel(params=args)
     model = torch.nn.DataParallel(model)
@@ -113,8 +119,18 @@ def test(params):
     start_time = time.time()
     with torch.no_grad():
         for _, sample in enumerate(tqdm(dataloader.data)):
-            image = Variable(sample['image'].cuda())
-            focal = Variable(sample['focal'].cuda())
+            if args.gpu_decode:
+                image = decode_jpeg(sample['image'][0], mode=ImageReadMode.RGB, device='cuda')
+                if args.do_kb_crop:
+                    height, width = image.shape[1:]
+                    top_margin = int(height - 352)
+                    left_margin = int((width - 1216) / 2)
+                    image = image[:, top_margin:top_margin + 352, left_margin:left_margin + 1216]
+                image = image.unsqueeze(0)
+            else:
+                image = sample['image'].cuda(non_blocking=True)
+            image = Variable(normalize_image(image))
+            focal = Variable(sample['focal'].cuda(non_blocking=True))
             # Predict
             lpg8x8, lpg4x4, lpg2x2, reduc1x1, depth_est = model(image, focal)
             pred_depths.append(depth_est.cpu().numpy().squeeze())